@@ -1,8 +1,144 @@
 import yaml
 import os
+import io
+import copy
+import time
+import uuid
+import shlex
+import posixpath
+import atexit
+import tarfile
+import threading
+import subprocess
 import paramiko
 import logging
-from typing import Dict, Any
+import fastjsonschema
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+# Prefer the libyaml C parser, fall back to the pure Python one when it isn't built
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Upper bound on the number of hosts configured at the same time
+MAX_PARALLEL_HOSTS = 32
+
+# Seconds between keepalive packets on pooled SSH connections
+SSH_KEEPALIVE_INTERVAL = 30
+
+# Seconds to wait for the TCP connection, the SSH banner and authentication before giving up on a host
+SSH_TIMEOUT = 10
+
+# Legacy algorithms paramiko would otherwise offer; group exchange also costs an extra round trip
+SSH_DISABLED_ALGORITHMS = {
+    'kex': [
+        'diffie-hellman-group1-sha1',
+        'diffie-hellman-group14-sha1',
+        'diffie-hellman-group-exchange-sha1',
+        'diffie-hellman-group-exchange-sha256',
+    ],
+    'keys': ['ssh-dss', 'ssh-rsa'],
+}
+
+# Options of the OpenSSH transport: the first connection to a host becomes a master that later
+# ssh invocations, also from other processes, reuse for 60s without a new handshake
+OPENSSH_OPTIONS = [
+    '-o', 'ControlMaster=auto',
+    '-o', 'ControlPersist=60s',
+    '-o', 'ControlPath=~/.ssh/cm-%r@%h:%p',
+    '-o', 'BatchMode=yes',
+    '-o', f'ConnectTimeout={SSH_TIMEOUT}',
+]
+
+# Files up to this size are shipped in one tar stream, larger ones go over SFTP
+ARCHIVE_FILE_MAX_BYTES = 8 * 1024 * 1024
+
+# Prefix of the per-item status lines printed by the remote script
+STATUS_MARKER = '@@scm'
+
+# Loads the names of the installed packages into a shell variable with a single dpkg query,
+# unless an earlier service check already did and no package was changed since
+LOAD_INSTALLED_PACKAGES = (
+    "scm_installed=${scm_installed-$(dpkg-query -W -f='${Status} ${Package}\\n' | awk '$3 == \"installed\" { print $4 }')}"
+)
+
+# Shape of config.yaml: a list of items whose required keys and accepted states depend on their type
+CONFIG_SCHEMA = {
+    '$schema': 'http://json-schema.org/draft-07/schema#',
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'required': ['type'],
+        'properties': {
+            'type': {'enum': ['file', 'package', 'service']},
+        },
+        'allOf': [
+            {
+                'if': {'properties': {'type': {'const': 'file'}}},
+                'then': {
+                    'required': ['path', 'content'],
+                    'properties': {
+                        'path': {'type': 'string'},
+                        'content': {'type': 'string'},
+                        'owner': {'type': 'string'},
+                        'group': {'type': 'string'},
+                        'mode': {'type': 'string', 'pattern': '^[0-7]{3,4}$'},
+                    },
+                },
+            },
+            {
+                'if': {'properties': {'type': {'const': 'package'}}},
+                'then': {
+                    'required': ['name', 'state'],
+                    'properties': {
+                        'name': {'type': 'string'},
+                        'state': {'enum': ['present', 'absent']},
+                    },
+                },
+            },
+            {
+                'if': {'properties': {'type': {'const': 'service'}}},
+                'then': {
+                    'required': ['name', 'state'],
+                    'properties': {
+                        'name': {'type': 'string'},
+                        'state': {'enum': ['start', 'stop', 'reload', 'restart']},
+                    },
+                },
+            },
+        ],
+    },
+}
+
+# Generated once at import into plain Python code checking CONFIG_SCHEMA, raises
+# fastjsonschema.JsonSchemaValueException (a ValueError) for an invalid configuration
+_validate_config = fastjsonschema.compile(CONFIG_SCHEMA)
+
+# Parsed YAML documents keyed by absolute path, validated by (mtime in nanoseconds, size)
+_YAML_CACHE: "OrderedDict[str, Tuple[int, int, Any]]" = OrderedDict()
+_YAML_CACHE_MAX = 100
+
+
+def _load_yaml_cached(path: str) -> Any:
+    # Only re-parse the file when it changed on disk since the last load
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    entry = _YAML_CACHE.get(path)
+    if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+        _YAML_CACHE.move_to_end(path)
+    else:
+        with open(path, 'r') as f:
+            entry = (st.st_mtime_ns, st.st_size, yaml.load(f, Loader=SafeLoader))
+        _YAML_CACHE[path] = entry
+        if len(_YAML_CACHE) > _YAML_CACHE_MAX:
+            _YAML_CACHE.popitem(last=False)
+
+    # Hand out a copy so callers can't mutate the cached document
+    return copy.deepcopy(entry[2])
+
 
 class SimpleConfigManager:
     '''
@@ -19,173 +155,458 @@ class SimpleConfigManager:
     Methods:
         apply(host: str) -> None:
             Applies the configuration tasks to the specified host.
-        _is_service_installed(ssh: paramiko.SSHClient, service_name: str) -> bool:
-            Checks if a service is installed on the remote host.
-        _manage_file(ssh: paramiko.SSHClient, item: Dict[str, Any]) -> None:
-            Manages a file on the remote host based on the configuration item.
-        _manage_package(ssh: paramiko.SSHClient, item: Dict[str, Any]) -> None:
-            Manages a package on the remote host based on the configuration item.
-        _manage_service(ssh: paramiko.SSHClient, item: Dict[str, Any]) -> None:
-            Manages a service on the remote host based on the configuration item.
+        apply_all(hosts: List[str]) -> None:
+            Applies the configuration tasks to all hosts concurrently.
+        _apply_openssh(host: str) -> None:
+            Applies the configuration tasks to the specified host through the OpenSSH client.
+        _openssh(host: str, command: str, data: bytes) -> subprocess.CompletedProcess:
+            Runs a command on the remote host over a multiplexed OpenSSH connection.
+        _build_script(staging: Optional[str]) -> str:
+            Returns the script that applies all configuration items on a remote host.
+        _batch_key(index: int, item: Dict[str, Any]) -> Any:
+            Returns the key grouping configuration items that run as a single step.
+        _get_conn(host: str) -> paramiko.SSHClient:
+            Returns a pooled, authenticated SSH connection to the host.
+        _is_alive(ssh: paramiko.SSHClient) -> bool:
+            Checks if the SSH connection's transport is still usable.
+        _drain_pool() -> None:
+            Closes every pooled SSH connection; registered to run at exit.
+        _run_script(ssh: paramiko.SSHClient, host: str, script: str) -> None:
+            Runs the generated script on the remote host and logs the status of each item.
+        _log_results(host: str, return_code: int, out: str, err: str) -> None:
+            Logs the status of each item from the script's status markers.
+        _upload_archive(ssh: paramiko.SSHClient, host: str, staging: str, items: Dict[int, Dict[str, Any]], create: bool) -> bool:
+            Uploads the files of the configuration items to the staging directory in a single tar stream.
+        _archive_command(staging: str, create: bool) -> str:
+            Returns the command unpacking the tar stream in the staging directory.
+        _write_archive(fileobj: Any, items: Dict[int, Dict[str, Any]]) -> None:
+            Writes the files of the configuration items as a tar stream to the file object.
+        _stage_files(sftp: paramiko.SFTPClient, host: str, staging: str, items: Dict[int, Dict[str, Any]]) -> bool:
+            Uploads the files too large for the tar stream to a staging directory over SFTP.
+        _remove_staging(ssh: paramiko.SSHClient, sftp: Optional[paramiko.SFTPClient], host: str, staging: str) -> None:
+            Removes the staging directory when the script won't run to remove it.
+        _is_large_file(item: Dict[str, Any]) -> bool:
+            Checks if the item is a file too large for the tar stream.
+        _staged_name(index: int) -> str:
+            Returns the name of a file in the staging directory.
+        _manage_file(indices: List[int], items: List[Dict[str, Any]]) -> List[str]:
+            Returns the commands that manage files on the remote host based on the configuration items.
+        _manage_package(indices: List[int], items: List[Dict[str, Any]]) -> List[str]:
+            Returns the commands that manage packages on the remote host based on the configuration items.
+        _manage_service(indices: List[int], items: List[Dict[str, Any]]) -> List[str]:
+            Returns the commands that manage services on the remote host based on the configuration items.
     '''
-    def __init__(self, config_file: str):
-        # Load configuration from the specified YAML file
-        with open(config_file, 'r') as f:
-            self.config = yaml.safe_load(f)
+    # Method building the commands for each item type
+    _HANDLERS = {'file': '_manage_file', 'package': '_manage_package', 'service': '_manage_service'}
+
+    # Authenticated SSH connections shared across apply() calls, keyed by (host, username)
+    _pool: Dict[Tuple[str, str], paramiko.SSHClient] = {}
+    _pool_lock = threading.Lock()
 
-        # Configure logging to write to a file with a specific format
-        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', filename='simpleconfigmanager.log', filemode='w')
+    def __init__(self, config_file: str, use_openssh: bool = False):
+        # Configure logging to write to a file with a specific format, only warnings and errors
+        # unless SCM_LOG_LEVEL asks for more (e.g. INFO or DEBUG)
+        logging.basicConfig(level=os.getenv('SCM_LOG_LEVEL', 'WARNING').upper(), format='%(asctime)s - %(levelname)s - %(message)s', filename='simpleconfigmanager.log', filemode='w')
         self.logger = logging.getLogger(__name__)
 
-    def apply(self, host: str) -> None:
-        # Retrieve SSH credentials from environment variables
-        username = os.getenv('SSH_USERNAME')
-        password = os.getenv('SSH_PASSWORD')
+        # Connection multiplexing (ControlMaster) isn't supported by OpenSSH on Windows, keep paramiko there
+        self._use_openssh = use_openssh and os.name != 'nt'
+        if use_openssh and not self._use_openssh:
+            self.logger.warning("The OpenSSH transport is not supported on Windows, using paramiko")
+
+        # Retrieve SSH credentials from environment variables once, they are the same for every host
+        self._user = os.getenv('SSH_USERNAME')
+        self._pw = os.getenv('SSH_PASSWORD')
 
-        # Check if SSH credentials are set
-        if not username or not password:
+        # Check if SSH credentials are set before any host is attempted; ssh runs non-interactively
+        # and authenticates with keys or the agent, so the OpenSSH transport needs no password
+        if not self._user:
+            self.logger.error("SSH_USERNAME environment variable must be set")
+            raise RuntimeError("SSH_USERNAME environment variable must be set")
+        if not self._pw and not self._use_openssh:
             self.logger.error("SSH_USERNAME and SSH_PASSWORD environment variables must be set")
+            raise RuntimeError("SSH_USERNAME and SSH_PASSWORD environment variables must be set")
+
+        # Load configuration from the specified YAML file
+        self.config = _load_yaml_cached(config_file)
+
+        # Validate the whole configuration once against the compiled schema, so an invalid
+        # configuration fails before any SSH work
+        try:
+            _validate_config(self.config)
+        except fastjsonschema.JsonSchemaValueException as e:
+            self.logger.error("Invalid configuration in %s: %s", config_file, e.message)
+            raise
+
+        # Group the items into steps with their handler so apply() doesn't branch on the type per host.
+        # Only consecutive items sharing a batch key run as one step, so the configuration order is kept
+        self._plan: List[Tuple[List[int], List[Dict[str, Any]], Any]] = []
+        previous = None
+        for index, item in enumerate(self.config):
+            key = self._batch_key(index, item)
+            if self._plan and key == previous:
+                self._plan[-1][0].append(index)
+                self._plan[-1][1].append(item)
+            else:
+                self._plan.append(([index], [item], getattr(self, self._HANDLERS[item['type']])))
+            previous = key
+
+        # Files are staged before the script runs: in one tar stream, or over SFTP when too large for it
+        # (ssh streams the archive efficiently, so the OpenSSH transport archives every file). The script
+        # moves each one into place at its position in the configuration. They are keyed by index, the
+        # same path may be written more than once
+        self._archive = {index: item for index, item in enumerate(self.config) if item['type'] == 'file' and not self._is_large_file(item)}
+        self._staged = {index: item for index, item in enumerate(self.config) if self._is_large_file(item)}
+
+    @staticmethod
+    def _batch_key(index: int, item: Dict[str, Any]) -> Any:
+        # Consecutive packages with the same state go through one apt-get call, consecutive services
+        # with the same state through one systemctl call, and files run on their own
+        if item['type'] in ('package', 'service'):
+            return (item['type'], item['state'])
+        return index
+
+    def apply(self, host: str) -> None:
+        if self._use_openssh:
+            self._apply_openssh(host)
             return
 
-        # Initialize SSH client and set policy to accept unknown host keys
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         try:
-            # Connect to the host using SSH
-            ssh.connect(host, username=username, password=password)
-            self.logger.info(f"Connected to {host}")
+            # Reuse the pooled connection to the host, connecting on first use
+            ssh = self._get_conn(host)
+            self.logger.info("Connected to %s", host)
         except paramiko.SSHException as e:
-            self.logger.error(f"SSH connection failed: {e}")
+            self.logger.error("SSH connection failed: %s", e)
             return
 
-        # Process each item in the configuration sequentially
-        for item in self.config:
-            self.logger.debug(f"Processing item: {item}")
-            try:
-                if item['type'] == 'file':
-                    self._manage_file(ssh, item)
-                elif item['type'] == 'package':
-                    state = item.get('state')
-                    if state not in ['present', 'absent']:
-                        self.logger.error(f"Invalid state '{state}' for package '{item['name']}'. Must be 'present' or 'absent'.")
-                        return
-                    self._manage_package(ssh, item)
-                elif item['type'] == 'service':
-                    state = item.get('state')
-                    if state not in ['start', 'stop', 'reload', 'restart']:
-                        self.logger.error(f"Invalid state '{state}' for service '{item['name']}'. Must be 'start', 'stop', 'reload', or 'restart'.")
-                        return
-                    if self._is_service_installed(ssh, item['name']):
-                        self._manage_service(ssh, item)
-                    else:
-                        self.logger.error(f"Service '{item['name']}' is not installed. Cannot perform any action on it")
-                        return
-            except Exception as e:
-                self.logger.error(f"Failed to manage {item['type']}: {e}")
-
-        # Close the SSH connection
-        ssh.close()
-        self.logger.info("SSH connection closed")
-
-    def _is_service_installed(self, ssh: paramiko.SSHClient, service_name: str) -> bool:
-        # Check if the service is installed by querying the package manager
+        # Files too large for the archive share one SFTP session, opened only when needed
+        sftp = ssh.open_sftp() if self._staged else None
         try:
-            stdin, stdout, stderr = ssh.exec_command(f"dpkg -l | awk '$2 == \"{service_name}\"'")
-            return_code = stdout.channel.recv_exit_status()
+            # Per-run staging directory for the files, removed when the script exits
+            staging = f"/tmp/.scm-{uuid.uuid4().hex}" if self._archive or self._staged else None
+            script = self._build_script(staging)
+
+            # The SFTP session creates the staging directory when it's used, otherwise the tar stream does
+            if self._staged and not self._stage_files(sftp, host, staging, self._staged):
+                self._remove_staging(ssh, sftp, host, staging)
+                return
+            if self._archive and not self._upload_archive(ssh, host, staging, self._archive, create=not self._staged):
+                self._remove_staging(ssh, sftp, host, staging)
+                return
+
+            self._run_script(ssh, host, script)
+        finally:
+            if sftp is not None:
+                # Close the SFTP session
+                sftp.close()
+                self.logger.debug("SFTP connection closed")
+
+    def _apply_openssh(self, host: str) -> None:
+        # Same steps as apply(), with the archive and the script going through the ssh master connection
+        staging = f"/tmp/.scm-{uuid.uuid4().hex}" if self._archive else None
+        script = self._build_script(staging)
+        if self._archive:
+            archive = io.BytesIO()
+            self._write_archive(archive, self._archive)
+            result = self._openssh(host, self._archive_command(staging, create=True), archive.getvalue())
+            if result.returncode != 0:
+                self.logger.error("Failed to upload files to %s: %s", host, result.stderr.decode().strip())
+                # The script won't run, so its EXIT trap can't remove the staging directory
+                self._openssh(host, f"rm -rf {shlex.quote(staging)}", b'')
+                return
+            self.logger.info("Uploaded %d file(s) to %s", len(self._archive), host)
+
+        result = self._openssh(host, "bash -s", script.encode())
+        self._log_results(host, result.returncode, result.stdout.decode(), result.stderr.decode().strip())
+
+    def _openssh(self, host: str, command: str, data: bytes) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            ['ssh', *OPENSSH_OPTIONS, '-l', self._user, host, command],
+            input=data,
+            capture_output=True,
+        )
 
-            if return_code == 0:
-                output = stdout.read().decode().strip()
-                if output:
-                    return True
+    def _build_script(self, staging: Optional[str]) -> str:
+        # Turn every item into shell commands so the whole configuration runs as
+        # a single script over one SSH channel instead of one round trip per command
+        script = ['set -e', f"trap 'echo \"{STATUS_MARKER} failed $scm_item\" >&3' ERR", "exec 3>&1"]
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            # Only the status markers on fd 3 come back; the commands' output (mostly apt's
+            # progress) would just be transferred and discarded
+            script.append("exec 1>/dev/null")
+        # apt-get and dpkg must never stop to ask a question, there is nobody to answer it
+        script.append("export DEBIAN_FRONTEND=noninteractive")
+        if staging is not None:
+            script += [f"scm_staging={staging}", "trap 'rm -rf \"$scm_staging\"' EXIT"]
+
+        # bash reads the script from stdin, which every command inherits: a command reading its stdin
+        # would swallow the rest of the script. Bash parses the whole group before running it, and the
+        # commands inside read /dev/null instead
+        script.append("{")
+        for indices, items, handler in self._plan:
+            # Skip even building the call on this hot path when debug logging is off
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Processing items: %r", items)
+            step = ','.join(map(str, indices))
+            script.append(f"scm_item={step}")
+            script.extend(handler(indices, items))
+            script.append(f"echo \"{STATUS_MARKER} ok {step}\" >&3")
+        script.append("} </dev/null")
+        return '\n'.join(script) + '\n'
+
+    def apply_all(self, hosts: List[str]) -> None:
+        # Each host is network-latency bound, so configure them concurrently
+        # instead of paying the per-host round trips one after the other
+        if not hosts:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(len(hosts), MAX_PARALLEL_HOSTS)) as executor:
+            futures = {executor.submit(self.apply, host): host for host in hosts}
+            for future, host in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error("Failed to apply configuration to %s: %s", host, e)
+
+    def _get_conn(self, host: str) -> paramiko.SSHClient:
+        key = (host, self._user)
+        with self._pool_lock:
+            ssh = self._pool.get(key)
+        if ssh is not None:
+            if self._is_alive(ssh):
+                return ssh
+            # The pooled transport died (e.g. the host rebooted), reconnect below
+            ssh.close()
+
+        # Initialize SSH client and only accept hosts that are already in known_hosts
+        ssh = paramiko.SSHClient()
+        ssh.load_system_host_keys()
+        ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
+        # Authenticate with the password only, without probing keys or the agent first
+        try:
+            ssh.connect(
+                host,
+                username=self._user,
+                password=self._pw,
+                timeout=SSH_TIMEOUT,
+                banner_timeout=SSH_TIMEOUT,
+                auth_timeout=SSH_TIMEOUT,
+                look_for_keys=False,
+                allow_agent=False,
+                disabled_algorithms=SSH_DISABLED_ALGORITHMS,
+            )
+        except Exception:
+            # Don't leak the client and its transport thread on every failed attempt
+            ssh.close()
+            raise
+        # Keep the connection alive while it sits idle in the pool
+        transport = ssh.get_transport()
+        transport.set_keepalive(SSH_KEEPALIVE_INTERVAL)
+
+        with self._pool_lock:
+            pooled = self._pool.get(key)
+            if pooled is not None and self._is_alive(pooled):
+                # Another thread connected to the same host first, keep its connection
+                ssh.close()
+                return pooled
+            self._pool[key] = ssh
+        return ssh
+
+    @staticmethod
+    def _is_alive(ssh: paramiko.SSHClient) -> bool:
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    @classmethod
+    def _drain_pool(cls) -> None:
+        with cls._pool_lock:
+            connections = list(cls._pool.values())
+            cls._pool.clear()
+        for ssh in connections:
+            ssh.close()
+        logging.getLogger(__name__).info("SSH connections closed")
+
+    def _run_script(self, ssh: paramiko.SSHClient, host: str, script: str) -> None:
+        # Feed the script to a remote shell through stdin
+        stdin, stdout, stderr = ssh.exec_command("bash -s")
+        stdin.write(script)
+        stdin.channel.shutdown_write()
+
+        # The markers are always read back to check every step reported. Read them to EOF before
+        # waiting for the exit status: when debugging, the commands' output comes along and can
+        # be more than the channel's window holds
+        out = stdout.read().decode()
+        return_code = stdout.channel.recv_exit_status()
+
+        # stderr explains a failure, and is logged as a warning when the script succeeded
+        err = stderr.read().decode().strip()
+        self._log_results(host, return_code, out, err)
+
+    def _log_results(self, host: str, return_code: int, out: str, err: str) -> None:
+        # The script prints a status marker with the item indices after each step, and one for the step that failed
+        failed = False
+        reported = set()
+        for line in out.splitlines():
+            if not line.startswith(f"{STATUS_MARKER} "):
+                self.logger.debug(line)
+                continue
+            _, status, step = line.split()
+            failed = failed or status != 'ok'
+            reported.add(step)
+            for index in step.split(','):
+                item = self.config[int(index)]
+                target = item.get('name', item.get('path'))
+                if status == 'ok':
+                    self.logger.info("Applied %s '%s' on %s", item['type'], target, host)
                 else:
-                    return False
-            else:
-                error_message = stderr.read().decode().strip()
-                return False
-        except Exception as e:
-            self.logger.error(f"An error occurred while checking service installation: {e}")
-            return False
+                    self.logger.error("Failed to manage %s '%s' on %s: %s", item['type'], target, host, err)
 
-    def _manage_file(self, ssh: paramiko.SSHClient, item: Dict[str, Any]) -> None:
-        # Open an SFTP session
-        content = item['content']
-        path = item['path']
-        owner = item.get('owner', 'www-data')
-        group = item.get('group', 'www-data')
-        mode = item.get('mode', '0644')
+        # A step without a marker never ran, whether an earlier step failed or the script was cut short
+        for indices, items, _ in self._plan:
+            if ','.join(map(str, indices)) not in reported:
+                for item in items:
+                    self.logger.error("Did not apply %s '%s' on %s", item['type'], item.get('name', item.get('path')), host)
 
-        sftp = ssh.open_sftp()
+        if return_code != 0 and not failed:
+            self.logger.error("Configuration script failed on %s with exit status %d: %s", host, return_code, err)
+        elif return_code == 0 and err:
+            self.logger.warning("Configuration script on %s reported: %s", host, err)
 
+    def _upload_archive(self, ssh: paramiko.SSHClient, host: str, staging: str, items: Dict[int, Dict[str, Any]], create: bool) -> bool:
+        # Stream a tar archive straight into the channel and unpack it in the staging directory
         try:
-            # Write content to the target file
-            with sftp.file(path, 'w') as f:
-                f.write(content)
-            self.logger.debug(f"Wrote content directly to file: {path}")
+            stdin, stdout, stderr = ssh.exec_command(self._archive_command(staging, create))
+            self._write_archive(stdin, items)
+            stdin.channel.shutdown_write()
+        except (OSError, paramiko.SSHException) as e:
+            # tar exited partway through (e.g. the disk is full) and closed the channel
+            self.logger.error("Failed to upload files to %s: %s", host, e)
+            return False
 
-            # Set ownership and permissions
-            ssh.exec_command(f"chown {owner}:{group} {path}")
-            ssh.exec_command(f"chmod {mode} {path}")
-            self.logger.info(f"Set ownership and permissions for {path}")
+        return_code = stdout.channel.recv_exit_status()
+        if return_code != 0:
+            self.logger.error("Failed to upload files to %s: %s", host, stderr.read().decode().strip())
+            return False
+        self.logger.info("Uploaded %d file(s) to %s", len(items), host)
+        return True
 
-            # Remove index.html if it exists(we don't need it)
-            index_html_path = "/var/www/html/index.html"
-            stdin, stdout, stderr = ssh.exec_command(f"rm -f {index_html_path}")
-            stdout.channel.recv_exit_status()  # Wait for the command to complete
-            self.logger.info(f"Removed {index_html_path} if it existed")
+    @staticmethod
+    def _archive_command(staging: str, create: bool) -> str:
+        # The staging directory is private to the SSH user, and creating it fails if it already exists
+        target = shlex.quote(staging)
+        command = f"tar xf - -C {target}"
+        return f"mkdir -m 700 {target} && {command}" if create else command
+
+    @classmethod
+    def _write_archive(cls, fileobj: Any, items: Dict[int, Dict[str, Any]]) -> None:
+        # Ownership and permissions are set by the script once the file is moved into place,
+        # when the owner and group created by earlier packages exist
+        mtime = time.time()
+        with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+            for index, item in items.items():
+                data = item['content'].encode()
+                info = tarfile.TarInfo(cls._staged_name(index))
+                info.size = len(data)
+                info.mtime = mtime
+                info.mode = 0o600
+                tar.addfile(info, io.BytesIO(data))
+
+    def _stage_files(self, sftp: paramiko.SFTPClient, host: str, staging: str, items: Dict[int, Dict[str, Any]]) -> bool:
+        try:
+            # Private to the SSH user, and creating it fails if it already exists
+            sftp.mkdir(staging, mode=0o700)
+            for index, item in items.items():
+                staged_path = f"{staging}/{self._staged_name(index)}"
+                data = item['content'].encode()
+                # putfo pipelines the writes rather than waiting for each write's ack
+                sftp.putfo(io.BytesIO(data), staged_path, file_size=len(data))
+                self.logger.debug("Staged content of %s at %s", item['path'], staged_path)
         except IOError as e:
-            self.logger.error(f"Failed to manage file: {e}")
-        finally:
-            # Close the SFTP session
-            sftp.close()
-            self.logger.debug("SFTP connection closed")
+            self.logger.error("Failed to stage files on %s: %s", host, e)
+            return False
+        return True
+
+    def _remove_staging(self, ssh: paramiko.SSHClient, sftp: Optional[paramiko.SFTPClient], host: str, staging: str) -> None:
+        # The script's EXIT trap only cleans up once the script has run, so after a failed
+        # transfer remove the staged contents here instead of leaving them in /tmp
+        try:
+            if sftp is not None:
+                for name in sftp.listdir(staging):
+                    sftp.remove(f"{staging}/{name}")
+                sftp.rmdir(staging)
+            else:
+                # Only the tar stream was used, there's no SFTP session to remove it with
+                _, stdout, _ = ssh.exec_command(f"rm -rf {shlex.quote(staging)}")
+                stdout.channel.recv_exit_status()
+        except (IOError, paramiko.SSHException) as e:
+            self.logger.warning("Failed to remove the staging directory %s on %s: %s", staging, host, e)
+
+    def _is_large_file(self, item: Dict[str, Any]) -> bool:
+        return (not self._use_openssh and item.get('type') == 'file'
+                and len(item.get('content', '').encode()) > ARCHIVE_FILE_MAX_BYTES)
 
+    @staticmethod
+    def _staged_name(index: int) -> str:
+        return str(index)
 
-    def _manage_package(self, ssh: paramiko.SSHClient, item: Dict[str, Any]) -> None:
-        name = item['name']
-        state = item.get('state')
+    def _manage_file(self, indices: List[int], items: List[Dict[str, Any]]) -> List[str]:
+        commands = []
+        for index, item in zip(indices, items):
+            path = item['path']
+            owner = item.get('owner', 'www-data')
+            group = item.get('group', 'www-data')
+            mode = item.get('mode', '0644')
 
-        self.logger.info(f"Managing package: {name}, state: {state}")
+            staged = f"\"$scm_staging\"/{self._staged_name(index)}"
+            # The file was staged by the tar stream or over SFTP and is moved into place from the script, so it
+            # lands in configuration order (e.g. after the package creating its directory, owner or conffile).
+            # Ownership and permissions are set first, so an unknown owner or group fails the item untouched
+            commands.append(f"chown {shlex.quote(f'{owner}:{group}')} {staged}")
+            commands.append(f"chmod {shlex.quote(mode)} {staged}")
+            commands.append(f"mkdir -p {shlex.quote(posixpath.dirname(path))}")
+            commands.append(f"mv {staged} {shlex.quote(path)}")
+
+            # Remove index.html if it exists(we don't need it)
+            commands.append("rm -f /var/www/html/index.html")
+        return commands
+
+    def _manage_package(self, indices: List[int], items: List[Dict[str, Any]]) -> List[str]:
+        # The items of a step are consecutive and share their state, see _batch_key()
+        names = [item['name'] for item in items]
+        state = items[0]['state']
+        self.logger.info("Managing packages: %s, state: %s", ', '.join(names), state)
+
+        # One apt-get run per step, so dpkg's lock and apt's dependency solver are paid once, not per package
         if state == 'present':
-            # Install the package
-            stdin, stdout, stderr = ssh.exec_command(f"apt-get install -y {name}")
-        elif state == 'absent':
-            # Remove the package
-            stdin, stdout, stderr = ssh.exec_command(f"apt-get purge -y {name} && apt-get autoremove -y")
+            # Install the packages
+            commands = ["apt-get install -y --no-install-recommends " + ' '.join(map(shlex.quote, names))]
         else:
-            self.logger.error(f"Unknown state '{state}' for package: {name}")
+            # Remove the packages
+            commands = ["apt-get purge -y " + ' '.join(map(shlex.quote, names)), "apt-get autoremove -y"]
 
-        # Log the output and errors
-        out = stdout.read().decode()
-        err = stderr.read().decode()
-        self.logger.info(out)
-        if err:
-            self.logger.error(f"Error installing {name}: {err}")
+        # The installed packages changed, the next service check has to query dpkg again
+        commands.append("unset scm_installed")
+        return commands
 
+    def _manage_service(self, indices: List[int], items: List[Dict[str, Any]]) -> List[str]:
+        # The items of a step are consecutive and share their state, see _batch_key(); a unit
+        # listed twice in a row is only checked and passed to systemctl once
+        names = list(dict.fromkeys(item['name'] for item in items))
+        state = items[0]['state']
+        self.logger.info("Managing services: %s, state: %s", ', '.join(names), state)
 
-    def _manage_service(self, ssh: paramiko.SSHClient, item: Dict[str, Any]) -> None:
-        name = item['name']
-        state = item.get('state')
-        self.logger.info(f"Managing service: {name}, state: {state}")
+        # Only manage the services if they are installed, looked up in the package list queried once per script
+        commands = [LOAD_INSTALLED_PACKAGES]
+        for name in names:
+            is_installed = f"printf '%s\\n' \"$scm_installed\" | grep -qxF {shlex.quote(name)}"
+            not_installed = shlex.quote(f"Service '{name}' is not installed. Cannot perform any action on it")
+            commands.append(f"{is_installed} || {{ echo {not_installed} >&2; false; }}")
 
-        try:
-            # Manage the service based on the desired state
-            if state == 'start':
-                ssh.exec_command(f"systemctl start {name}")
-                self.logger.info(f"Started service: {name}")
-            elif state == 'stop':
-                ssh.exec_command(f"systemctl stop {name}")
-                self.logger.info(f"Stopped service: {name}")
-            elif state == 'restart':
-                ssh.exec_command(f"systemctl restart {name}")
-                self.logger.info(f"Restarted service: {name}")
-            elif state == 'reload':
-                ssh.exec_command(f"systemctl reload {name}")
-                self.logger.info(f"Reloaded service: {name}")
-            else:
-                self.logger.error(f"Unknown state '{state}' for service: {name}")
-                return
-        except Exception as e:
-            self.logger.error(f"Failed to manage service {name}: {e}")
+        # systemctl takes several units at once, a single call for all of them
+        commands.append(f"systemctl {state} " + ' '.join(map(shlex.quote, names)))
+        return commands
+
+atexit.register(SimpleConfigManager._drain_pool)
 
 if __name__ == "__main__":
     '''
@@ -198,7 +619,7 @@ if __name__ == "__main__":
     Workflow:
     1. Initialize the SimpleConfigManager with 'config.yaml'.
     2. Load the inventory of hosts from 'hosts.yaml'.
-    3. Iterate over each server in the inventory and apply the configuration.
+    3. Apply the configuration to all servers in the inventory concurrently.
 
     Exception Handling:
     - Logs an error message if any exception occurs during the process.
@@ -208,11 +629,9 @@ if __name__ == "__main__":
     - The inventory file 'hosts.yaml' should contain a list of servers under the 'servers' key.
     '''
     try:
-        config = SimpleConfigManager('config.yaml')
-        with open('hosts.yaml', 'r') as f:
-            inventory = yaml.safe_load(f)
-        for server in inventory['servers']:
-            config.apply(server['host'])
+        config = SimpleConfigManager('config.yaml', use_openssh=os.getenv('SCM_USE_OPENSSH') == '1')
+        inventory = _load_yaml_cached('hosts.yaml')
+        config.apply_all([server['host'] for server in inventory['servers']])
 
     except Exception as e:
-        config.logger.error(f"An error occurred: {str(e)}")
+        logging.getLogger(__name__).error("An error occurred: %s", e)